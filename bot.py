@@ -1,10 +1,12 @@
 import asyncio
+import atexit
 import logging
+import math
 import random
 import re
-from datetime import datetime
-from functools import lru_cache
-from typing import Dict, List
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
 
 from telegram import Update
 from telegram.constants import ChatAction
@@ -30,8 +32,12 @@ SYSTEM_PROMPT = (
 )
 
 MAX_TOKENS_CONTEXT = 4096          # tokens we keep in the prompt
+MAX_HISTORY_MSGS = 64              # hard cap on messages sent, system prompt included
 MAX_TOKENS_REPLY = 300             # model reply length
 TEMPERATURE = 0.7
+FIRST_CHUNK_CHARS = 125            # first message goes out at the next sentence end past this
+ENCODE_THREADS = 4                 # tiktoken threads for batch token counting
+ENCODE_BATCH_MIN = 8               # fewer texts than this are encoded one by one
 
 RESET_TRIGGER = "/done"           # phrase that wipes context
 PRESET_RESPONSES = [               # bot replies when resetting
@@ -42,88 +48,177 @@ PRESET_RESPONSES = [               # bot replies when resetting
 
 LOG_FILE = "chat_log.txt"          # where all turns are appended
 
+_rng = random.Random()             # private generator for reply picks and pauses
+
+# whole-word, case-insensitive match ("/done", not "/doneness")
+_RESET_RE = re.compile(rf"(?<!\w){re.escape(RESET_TRIGGER)}(?!\w)", re.IGNORECASE)
+
 # ────────────────────────────────────────────────────────────
 # LOGGING (stdout for diagnostics, separate file for content)
 # ────────────────────────────────────────────────────────────
-logging.basicConfig(
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-    level=logging.INFO,
-)
 logger = logging.getLogger(__name__)
 
 
+_LOG_FH = open(LOG_FILE, "a", encoding="utf-8")  # kept open for the process lifetime
+atexit.register(_LOG_FH.close)
+_LOG_QUEUE: "asyncio.Queue[Optional[str]]" = asyncio.Queue()  # None = stop
+
+
+def _write_lines(lines: List[str]) -> None:
+    _LOG_FH.writelines(lines)
+    _LOG_FH.flush()
+
+
+async def _log_writer() -> None:
+    # Single consumer: drains whatever piled up and appends it in one write,
+    # off the event loop so a slow disk doesn't stall every chat. Returns
+    # once the None sentinel is reached, after writing everything before it.
+    while True:
+        batch = [await _LOG_QUEUE.get()]
+        while not _LOG_QUEUE.empty():
+            batch.append(_LOG_QUEUE.get_nowait())
+        lines = [line for line in batch if line is not None]
+        try:
+            await asyncio.to_thread(_write_lines, lines)
+        except Exception:
+            logger.exception("Failed to write to %s", LOG_FILE)
+        if len(lines) != len(batch):
+            return
+
+
+async def _start_log_writer(app: Application) -> None:
+    app.bot_data["log_writer"] = asyncio.create_task(_log_writer())
+
+
+async def _flush_log(app: Application) -> None:
+    writer = app.bot_data.pop("log_writer", None)
+    if writer:
+        _LOG_QUEUE.put_nowait(None)
+        await writer
+
+
+_NL_TABLE = str.maketrans({"\n": " ", "\r": " "})  # keep one turn per log line
+_last_ts_sec = 0
+_last_ts_str = ""
+
+
+def _timestamp() -> str:
+    # Second resolution is all we log, so format at most once per second.
+    global _last_ts_sec, _last_ts_str
+    now = int(time.time())
+    if now != _last_ts_sec:
+        _last_ts_str = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        _last_ts_sec = now
+    return _last_ts_str
+
+
 def _log_turn(role: str, chat_id: int, text: str) -> None:
-    line = (
-        f"{datetime.utcnow().isoformat(timespec='seconds')}Z | "
-        f"{chat_id} | {role:<9} | {text.replace('\n', ' ')}\n"
-    )
-    with open(LOG_FILE, "a", encoding="utf-8") as fh:
-        fh.write(line)
+    safe = text.translate(_NL_TABLE) if "\n" in text or "\r" in text else text
+    line = f"{_timestamp()} | {chat_id} | {role:<9} | {safe}\n"
+    _LOG_QUEUE.put_nowait(line)
 
 
 # ────────────────────────────────────────────────────────────
 # TOKEN‑COUNT HELPERS
 # ────────────────────────────────────────────────────────────
-@lru_cache(maxsize=1)
-def _get_encoder():
-    try:
-        return tiktoken.encoding_for_model(MODEL_NAME)
-    except KeyError:
-        return tiktoken.get_encoding("cl100k_base")
-
-
-def num_tokens(msgs: List[Dict[str, str]]) -> int:
-    enc = _get_encoder()
-    tokens = 0
-    for m in msgs:
-        tokens += 4
-        tokens += len(enc.encode(m["content"]))
-    tokens += 2
+try:
+    _ENC = tiktoken.encoding_for_model(MODEL_NAME)
+except KeyError:
+    _ENC = tiktoken.get_encoding("cl100k_base")
+
+
+def _token_bound(content: str) -> int:
+    # Every BPE token covers at least one UTF-8 byte, so the byte length is a
+    # cheap count that can only overshoot.
+    return len(content) if content.isascii() else len(content.encode("utf-8"))
+
+
+def _count_batch(contents: List[str]) -> List[int]:
+    # encode_ordinary_batch spins up a fresh thread pool on every call, which
+    # only pays off for larger batches; small ones are encoded in place.
+    if len(contents) < ENCODE_BATCH_MIN:
+        return [len(_ENC.encode_ordinary(c)) for c in contents]
+    batch = _ENC.encode_ordinary_batch(contents, num_threads=ENCODE_THREADS)
+    return [len(toks) for toks in batch]
+
+
+# fixed prefix, encoded once at import
+_SYSTEM_PROMPT_NTOK = len(_ENC.encode_ordinary(SYSTEM_PROMPT))
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+_EMPTY_HISTORY_TOKENS = 2 + 4 + _SYSTEM_PROMPT_NTOK  # system prompt + priming
+
+
+async def _tighten_counts(
+    history: Deque[Dict[str, str]], ntoks: Deque[Optional[int]], tokens: int
+) -> int:
+    # """Replaces byte-length bounds (None in `ntoks`) with exact counts,
+    # encoded in one batch off the event loop; returns the corrected total."""
+    pending = [i for i, n in enumerate(ntoks) if n is None]
+    if not pending:
+        return tokens
+    contents = [history[i]["content"] for i in pending]
+    counts = await asyncio.to_thread(_count_batch, contents)
+    for i, content, n in zip(pending, contents, counts):
+        tokens += n - _token_bound(content)
+        ntoks[i] = n
     return tokens
 
 
-def trim_to_limit(msgs: List[Dict[str, str]], limit: int = MAX_TOKENS_CONTEXT) -> None:
-    # """Mutates `msgs`, deleting oldest non - system messages until ≤ limit."""
-    while len(msgs) > 2 and num_tokens(msgs) > limit:
-        del msgs[1]  # drop the oldest after system prompt
+def trim_to_limit(
+    history: Deque[Dict[str, str]],
+    ntoks: Deque[Optional[int]],
+    tokens: int,
+    limit: int = MAX_TOKENS_CONTEXT,
+) -> int:
+    # """Mutates `history` (system prompt excluded) and its per-message token
+    # counts `ntoks` in lockstep, dropping the oldest messages until
+    # ≤ MAX_HISTORY_MSGS and ≤ limit tokens, always keeping the newest one.
+    # `tokens` is the running count; the updated count is returned."""
+    while len(history) > 1 and (
+        len(history) >= MAX_HISTORY_MSGS or tokens > limit
+    ):
+        content = history.popleft()["content"]
+        n = ntoks.popleft()
+        tokens -= 4 + (_token_bound(content) if n is None else n)
+    return tokens
 
 
 # ────────────────────────────────────────────────────────────
 # TEXT‑SPLITTING: send 1–2 messages with pauses
 # ────────────────────────────────────────────────────────────
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')   # whitespace after . ! or ?
+
+
 def _split_reply(text: str, force_two: bool = False) -> List[str]:
     #"""
     #Return one or two chunks, always ending on sentence boundaries.
     #• If the reply is short (≤250 chars) and force_two is False → one chunk.
     #• Otherwise we split after the last full sentence that keeps
     #  the first chunk ≈½ of the original length.
+    #• Whitespace inside each chunk (e.g. newlines between paragraphs) is
+    #  kept as-is, and the halfway mark is measured on the raw text.
     #"""
     if not force_two and len(text) <= 250:
         return [text]
 
-    # Split into sentences using simple punctuation look‑behind
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-    if len(sentences) == 1:                     # no punctuation found
+    # Cut at the first sentence boundary past the halfway mark. The scan
+    # starts there (backed up over a whitespace run straddling it) rather
+    # than walking every boundary in the first half.
+    half_len = len(text) / 2
+    start = math.ceil(half_len)
+    while start and text[start - 1].isspace():
+        start -= 1
+    boundary = _SENT_SPLIT.search(text, start)
+    if boundary is None:                        # fall back to the last one
+        for boundary in _SENT_SPLIT.finditer(text, 0, start):
+            pass
+
+    if boundary is None:                        # no punctuation found
         cut = text.rfind(" ", 0, len(text) // 2)  # fallback: nearest space
         return [text[:cut].strip(), text[cut + 1 :].strip()]
 
-    half_len  = len(text) / 2
-    part1, part2 = [], []
-    char_count = 0
-
-    for s in sentences:
-        # Keep adding sentences to part1 until we cross halfway
-        if char_count < half_len or not part1:
-            part1.append(s)
-            char_count += len(s) + 1            # +1 for a space/newline
-        else:
-            part2.append(s)
-
-    # Edge case: everything landed in part1 → move last sentence to part2
-    if not part2:
-        part2.append(part1.pop())
-
-    return [" ".join(part1).strip(), " ".join(part2).strip()]
+    # No boundary past halfway → the last sentence alone becomes part 2
+    return [text[: boundary.start()].strip(), text[boundary.end() :].strip()]
 
 
 # ────────────────────────────────────────────────────────────
@@ -142,9 +237,11 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _log_turn("user", chat_id, user_text)
 
     # ── 0) RESET TRIGGER ────────────────────────────────────
-    if RESET_TRIGGER.lower() in user_text.lower():
-        context.chat_data["history"] = []  # wipe
-        reply = random.choice(PRESET_RESPONSES)
+    if _RESET_RE.search(user_text):
+        context.chat_data["history"] = deque()  # wipe
+        context.chat_data["history_ntok"] = deque()
+        context.chat_data["history_tokens"] = _EMPTY_HISTORY_TOKENS
+        reply = _rng.choice(PRESET_RESPONSES)
         await msg.reply_text(reply)
         _log_turn("assistant", chat_id, reply)
         return
@@ -153,48 +250,116 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
 
     # ── 2) History init/fetch ───────────────────────────────
-    history: List[Dict[str, str]] = context.chat_data.get("history", [])
-    if not history:
-        history.append({"role": "system", "content": SYSTEM_PROMPT})
+    # the system prompt is kept out of `history` and prepended per request;
+    # `history_ntok` holds each message's token count so the dicts stay clean;
+    # new turns start as None and are counted only once the total nears the
+    # limit, until then `history_tokens` uses their byte length as a bound
+    history: Deque[Dict[str, str]] = context.chat_data.setdefault("history", deque())
+    ntoks: Deque[Optional[int]] = context.chat_data.get("history_ntok")
+    if ntoks is None or len(ntoks) != len(history):
+        # counts missing (new chat or restored data): count everything once
+        counts: List[int] = []
+        if history:
+            counts = await asyncio.to_thread(
+                _count_batch, [m["content"] for m in history]
+            )
+        ntoks = deque(counts)
+        context.chat_data["history_ntok"] = ntoks
+        context.chat_data["history_tokens"] = _EMPTY_HISTORY_TOKENS + sum(
+            4 + n for n in ntoks
+        )
+    history_tokens: int = context.chat_data["history_tokens"]
 
     history.append({"role": "user", "content": user_text})
-    trim_to_limit(history)
-
-    # ── 3) Call the LLM ─────────────────────────────────────
+    ntoks.append(None)
+    history_tokens += 4 + _token_bound(user_text)
+    if history_tokens > MAX_TOKENS_CONTEXT:
+        # the bound says we may be over: get exact counts before trimming
+        history_tokens = await _tighten_counts(history, ntoks, history_tokens)
+    history_tokens = trim_to_limit(history, ntoks, history_tokens)
+    context.chat_data["history_tokens"] = history_tokens
+
+    # ── 3) Stream from the LLM, sending the first chunk early ─
+    pieces: List[str] = []       # every delta, for the history entry
+    buf = ""                     # text not yet sent to the user
+    sent = False
+    scan_pos = FIRST_CHUNK_CHARS
     try:
-        completion = await client.chat.completions.create(
+        stream = await client.chat.completions.create(
             model=MODEL_NAME,
-            messages=history,
+            messages=[_SYSTEM_MSG, *history],
             max_tokens=MAX_TOKENS_REPLY,
             temperature=TEMPERATURE,
+            stream=True,
         )
-        full_reply = completion.choices[0].message.content.strip()
+        async for event in stream:
+            delta = event.choices[0].delta.content if event.choices else None
+            if not delta:
+                continue
+            pieces.append(delta)
+            buf += delta
+            if sent or len(buf) <= scan_pos:
+                continue
+
+            # First sentence boundary past FIRST_CHUNK_CHARS → send it now
+            boundary = _SENT_SPLIT.search(buf, scan_pos)
+            if boundary is None:
+                scan_pos = len(buf)
+                continue
+            first = buf[: boundary.start()].strip()
+            buf = buf[boundary.end() :]
+            await msg.reply_text(first)
+            _log_turn("assistant", chat_id, first)
+            sent = True
+            await context.bot.send_chat_action(
+                chat_id=chat_id, action=ChatAction.TYPING
+            )
     except Exception as err:
         logger.exception(err)
         await msg.reply_text("Oops")
         return
 
-    # ── 4) Send reply in 1–2 chunks with delays ─────────────
-    chunks = _split_reply(full_reply)
-    for ix, chunk in enumerate(chunks):
-        if ix:  # pause before second message
-            await asyncio.sleep(random.uniform(0.4, 1.1))
+    full_reply = "".join(pieces).strip()
+
+    # ── 4) Send the rest in 1–2 chunks with delays ──────────
+    rest = buf.strip()
+    if not sent:
+        chunks = _split_reply(rest)      # no early boundary: split as before
+    else:
+        chunks = [rest] if rest else []
+    for chunk in chunks:
+        if sent:  # pause before second message
+            await asyncio.sleep(_rng.uniform(0.4, 1.1))
             await context.bot.send_chat_action(
                 chat_id=chat_id, action=ChatAction.TYPING
             )
         await msg.reply_text(chunk)
         _log_turn("assistant", chat_id, chunk)
+        sent = True
 
     # ── 5) Save combined reply to history ───────────────────
+    if context.chat_data.get("history") is not history:
+        return  # context was reset while we were replying
     history.append({"role": "assistant", "content": full_reply})
-    context.chat_data["history"] = history
+    ntoks.append(None)
+    context.chat_data["history_tokens"] += 4 + _token_bound(full_reply)
 
 
 # ────────────────────────────────────────────────────────────
 # BOT ENTRY‑POINT
 # ────────────────────────────────────────────────────────────
 def main() -> None:
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    logging.basicConfig(
+        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+        level=logging.INFO,
+    )
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(_start_log_writer)
+        .post_shutdown(_flush_log)
+        .build()
+    )
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_msg))
 
     logger.info("Bot started - polling…")